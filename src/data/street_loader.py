@@ -2,26 +2,65 @@
 Load and process street network data.
 """
 import os
+from concurrent.futures import ThreadPoolExecutor
 import geopandas as gpd
 import osmnx as ox
-from ..utils.config import PROCESSED_DATA_DIR, DEFAULT_CRS, get_city_parameters, LEGACY_CITY_PARAMS
+from ..utils.config import PROCESSED_DATA_DIR, DEFAULT_CRS, LEGACY_CITY_PARAMS
 import pandas as pd
 import logging
 from pathlib import Path
+from typing import Optional, Tuple
 
 logger = logging.getLogger(__name__)
 
-def load_street_network(city: str):
-    """Load or download street network for any city worldwide."""
+# Keep concurrent Overpass requests low to avoid hammering the public instance
+MAX_DOWNLOAD_WORKERS = 4
+
+# Street cache layout and spatial filtering
+CACHE_ROW_GROUP_SIZE = 10000  # street segments per parquet row group
+BBOX_MARGIN = 0.001  # degrees (~100 m), comfortably above any buffer distance
+
+def street_cache_file(city: str) -> str:
+    """Path of the parquet street cache for a city."""
     # Clean city name for caching
     clean_name = city.lower().replace(' ', '_').replace(',', '').replace('/', '_')
-    cache_file = os.path.join(PROCESSED_DATA_DIR, f"{clean_name}_streets.geojson")
+    return os.path.join(PROCESSED_DATA_DIR, f"{clean_name}_streets.parquet")
+
+def load_street_network(city: str, bbox: Optional[Tuple[float, float, float, float]] = None):
+    """
+    Load or download street network for any city worldwide.
+    
+    Args:
+        city: Name of the city (can be any city worldwide)
+        bbox: Optional (min_lon, min_lat, max_lon, max_lat) area of interest;
+            when loading from cache only streets near this area are read
+        
+    Returns:
+        GeoDataFrame of street segments
+    """
+    cache_file = street_cache_file(city)
+    legacy_cache_file = os.path.splitext(cache_file)[0] + '.geojson'
     
     # Check if we have a cached version
     if os.path.exists(cache_file):
         logger.info(f"Loading streets from cache: {cache_file}")
         try:
-            return gpd.read_file(cache_file)
+            if bbox is not None:
+                try:
+                    return gpd.read_parquet(cache_file, bbox=_padded_bbox(bbox))
+                except ValueError:
+                    # Caches written before spatial ordering have no bbox column
+                    logger.info("Street cache has no bbox column, loading it in full")
+            return _clip_to_bbox(gpd.read_parquet(cache_file), bbox)
+        except Exception as e:
+            logger.warning(f"Failed to load cached streets: {e}")
+            # Continue to re-download
+    elif os.path.exists(legacy_cache_file):
+        logger.info(f"Loading streets from legacy GeoJSON cache: {legacy_cache_file}")
+        try:
+            streets_gdf = gpd.read_file(legacy_cache_file, engine='pyogrio', use_arrow=True)
+            streets_gdf = _save_streets(streets_gdf, cache_file)
+            return _clip_to_bbox(streets_gdf, bbox)
         except Exception as e:
             logger.warning(f"Failed to load cached streets: {e}")
             # Continue to re-download
@@ -31,13 +70,27 @@ def load_street_network(city: str):
     try:
         # Check if this is a legacy city with special handling
         if city.lower() in LEGACY_CITY_PARAMS and 'boroughs' in LEGACY_CITY_PARAMS[city.lower()]:
-            return _load_legacy_city_network(city, cache_file)
+            streets_gdf = _load_legacy_city_network(city, cache_file)
         else:
-            return _load_generic_city_network(city, cache_file)
+            streets_gdf = _load_generic_city_network(city, cache_file)
             
     except Exception as e:
         logger.error(f"Failed to load street network for {city}: {e}")
         return gpd.GeoDataFrame(geometry=[], crs=DEFAULT_CRS)
+    
+    return _clip_to_bbox(streets_gdf, bbox)
+
+def _padded_bbox(bbox: Tuple[float, float, float, float]) -> Tuple[float, float, float, float]:
+    """Widen a bbox by BBOX_MARGIN so streets just outside it are kept."""
+    min_x, min_y, max_x, max_y = bbox
+    return (min_x - BBOX_MARGIN, min_y - BBOX_MARGIN, max_x + BBOX_MARGIN, max_y + BBOX_MARGIN)
+
+def _clip_to_bbox(streets_gdf: gpd.GeoDataFrame, bbox: Optional[Tuple[float, float, float, float]]):
+    """Keep the streets whose bounds meet the padded bbox, matching a bbox cache read."""
+    if bbox is None:
+        return streets_gdf
+    min_x, min_y, max_x, max_y = _padded_bbox(bbox)
+    return streets_gdf.cx[min_x:max_x, min_y:max_y]
 
 def _load_generic_city_network(city: str, cache_file: str):
     """Load street network for any generic city."""
@@ -80,17 +133,27 @@ def _load_legacy_city_network(city: str, cache_file: str):
     
     all_streets = []
     
-    for area in areas:
-        logger.info(f"Loading streets for {area}...")
-        try:
-            # Download street network
-            G = ox.graph_from_place(area, network_type='drive')
+    # Downloads are I/O bound, so fetch a few areas concurrently while
+    # letting osmnx respect the Overpass rate limit, then restore the caller's setting
+    previous_rate_limit = ox.settings.overpass_rate_limit
+    ox.settings.overpass_rate_limit = True
+    try:
+        with ThreadPoolExecutor(max_workers=MAX_DOWNLOAD_WORKERS) as executor:
+            futures = {}
+            for area in areas:
+                logger.info(f"Loading streets for {area}...")
+                futures[executor.submit(ox.graph_from_place, area, network_type='drive')] = area
             
-            # Convert to GeoDataFrame
-            streets_gdf = ox.graph_to_gdfs(G, nodes=False, edges=True)
-            all_streets.append(streets_gdf)
-        except Exception as e:
-            logger.warning(f"Error loading streets for {area}: {e}")
+            # Collect in submission order so street IDs stay stable between runs
+            for future, area in futures.items():
+                try:
+                    # Convert to GeoDataFrame
+                    streets_gdf = ox.graph_to_gdfs(future.result(), nodes=False, edges=True)
+                    all_streets.append(streets_gdf)
+                except Exception as e:
+                    logger.warning(f"Error loading streets for {area}: {e}")
+    finally:
+        ox.settings.overpass_rate_limit = previous_rate_limit
     
     if not all_streets:
         raise Exception("No street networks could be loaded")
@@ -114,8 +177,27 @@ def _process_and_save_streets(streets_gdf: gpd.GeoDataFrame, cache_file: str):
         streets_gdf.set_crs(DEFAULT_CRS, inplace=True)
     
     # Save to file
-    os.makedirs(os.path.dirname(cache_file), exist_ok=True)
-    streets_gdf.to_file(cache_file, driver='GeoJSON')
+    streets_gdf = _save_streets(streets_gdf, cache_file)
     logger.info(f"Cached street network with {len(streets_gdf)} segments")
     
+    return streets_gdf
+
+def _save_streets(streets_gdf: gpd.GeoDataFrame, cache_file: str):
+    """Write street data to the parquet cache and return it in cache order."""
+    # OSM tags may hold either a single value or a list; parquet needs one
+    # type per column, so store such columns as strings like GeoJSON did
+    for column in streets_gdf.columns:
+        values = streets_gdf[column]
+        if values.dtype == object and values.map(lambda v: isinstance(v, list)).any():
+            streets_gdf[column] = values.where(values.isna(), values.astype(str))
+    
+    # Order streets along a Hilbert curve so each row group covers a compact
+    # area, letting bbox reads skip the row groups away from the walks
+    streets_gdf = streets_gdf.iloc[streets_gdf.geometry.hilbert_distance().argsort()]
+    
+    os.makedirs(os.path.dirname(cache_file), exist_ok=True)
+    streets_gdf.to_parquet(
+        cache_file, compression='zstd', write_covering_bbox=True, row_group_size=CACHE_ROW_GROUP_SIZE
+    )
+    
     return streets_gdf 
\ No newline at end of file
@@ -1,62 +1,90 @@
 """
 Process walking data from various sources.
 """
-import xml.etree.ElementTree as ET
+import os
+from array import array
+from multiprocessing import Pool
+from multiprocessing.pool import ThreadPool
 import geopandas as gpd
-from shapely.geometry import LineString, Point
+import numpy as np
+import shapely
 import pandas as pd
-from datetime import datetime
+from lxml import etree
+from pyproj import Transformer
 from pathlib import Path
 from typing import List, Dict, Optional
 import pytz
-from ..utils.config import DEFAULT_CRS, MIN_WALK_DURATION, MIN_WALK_DISTANCE, METRIC_CRS
+from ..utils.config import DEFAULT_CRS, MIN_WALK_DURATION, MIN_WALK_DISTANCE, METRIC_CRS, SIMPLIFY_BUFFER_FRACTION
+
+# TCX files use a namespace
+TCX_NAMESPACE = 'http://www.garmin.com/xmlschemas/TrainingCenterDatabase/v2'
+ACTIVITY_TAG = f'{{{TCX_NAMESPACE}}}Activity'
+TRACKPOINT_TAG = f'{{{TCX_NAMESPACE}}}Trackpoint'
+TIME_TAG = f'{{{TCX_NAMESPACE}}}Time'
+POSITION_TAG = f'{{{TCX_NAMESPACE}}}Position'
+LATITUDE_TAG = f'{{{TCX_NAMESPACE}}}LatitudeDegrees'
+LONGITUDE_TAG = f'{{{TCX_NAMESPACE}}}LongitudeDegrees'
+
+EARTH_RADIUS = 6371000  # meters
+
+# Per-walk metrics attached at ingest
+WALK_METRIC_COLUMNS = ['duration_s', 'length_m', 'straight_m', 'sinuosity', 'avg_speed']
+
+# Parse walk files with worker processes ('process') or threads ('thread')
+WALK_PARALLEL_BACKEND = os.environ.get('WALK_PARALLEL_BACKEND', 'process')
+
+# Reused for every walk so the projection pipeline is only set up once
+_TO_METRIC = Transformer.from_crs(DEFAULT_CRS, METRIC_CRS, always_xy=True)
 
 def parse_tcx_file(file_path: str) -> Optional[Dict]:
     """Parse a TCX file and extract walk data."""
     try:
-        tree = ET.parse(file_path)
-        root = tree.getroot()
+        lats = array('d')
+        lons = array('d')
+        times = []
+        activity_found = False
         
-        # TCX files use a namespace
-        ns = {'ns': 'http://www.garmin.com/xmlschemas/TrainingCenterDatabase/v2'}
-        
-        # Get activity type
-        activity = root.find('.//ns:Activity', ns)
-        if activity is None:
-            return None
+        # Stream the file so the full tree is never held in memory; the
+        # Activity end event follows its trackpoints but still has its attributes
+        context = etree.iterparse(file_path, events=('end',), tag=(ACTIVITY_TAG, TRACKPOINT_TAG))
+        for _, elem in context:
+            if elem.tag == ACTIVITY_TAG:
+                # Get activity type
+                activity_found = True
+                if elem.get('Sport') != 'Walking':
+                    return None
+                continue
             
-        activity_type = activity.get('Sport')
-        if activity_type != 'Walking':
-            return None
-            
-        # Get trackpoints
-        trackpoints = []
-        for trackpoint in root.findall('.//ns:Trackpoint', ns):
-            time = trackpoint.find('ns:Time', ns)
-            position = trackpoint.find('ns:Position', ns)
+            time = elem.findtext(TIME_TAG)
+            position = elem.find(POSITION_TAG)
             
             if time is not None and position is not None:
-                lat = position.find('ns:LatitudeDegrees', ns)
-                lon = position.find('ns:LongitudeDegrees', ns)
+                lat = position.findtext(LATITUDE_TAG)
+                lon = position.findtext(LONGITUDE_TAG)
                 
                 if lat is not None and lon is not None:
-                    trackpoints.append({
-                        'time': datetime.fromisoformat(time.text.replace('Z', '+00:00')),
-                        'lat': float(lat.text),
-                        'lon': float(lon.text)
-                    })
+                    lats.append(float(lat))
+                    lons.append(float(lon))
+                    times.append(time)
+            
+            # Free the processed trackpoint and any preceding siblings
+            elem.clear()
+            while elem.getprevious() is not None:
+                del elem.getparent()[0]
         
-        if len(trackpoints) < 2:
+        if not activity_found or len(times) < 2:
             return None
             
-        # Create walk data
-        coords = [(tp['lon'], tp['lat']) for tp in trackpoints]
-        times = [tp['time'] for tp in trackpoints]
+        # Create walk data; only the first and last timestamps are kept, so
+        # there is no need to parse the ones in between. Coordinates are
+        # returned as an array so geometries can be built for all walks at once.
+        coords = np.column_stack([np.asarray(lons), np.asarray(lats)])
+        start_time, end_time = pd.to_datetime([times[0], times[-1]], utc=True, format='ISO8601')
         
         return {
-            'geometry': LineString(coords),
-            'start_time': times[0],
-            'end_time': times[-1],
+            'coords': coords,
+            'start_time': start_time,
+            'end_time': end_time,
             'source_file': Path(file_path).name
         }
         
@@ -64,146 +92,179 @@ def parse_tcx_file(file_path: str) -> Optional[Dict]:
         print(f"Error parsing TCX file {file_path}: {e}")
         return None
 
+def _haversine(lon1, lat1, lon2, lat2) -> np.ndarray:
+    """Calculate great-circle distances in meters between WGS84 points."""
+    lon1, lat1, lon2, lat2 = map(np.radians, (lon1, lat1, lon2, lat2))
+    a = (
+        np.sin((lat2 - lat1) / 2) ** 2 +
+        np.cos(lat1) * np.cos(lat2) * np.sin((lon2 - lon1) / 2) ** 2
+    )
+    return 2 * EARTH_RADIUS * np.arcsin(np.sqrt(a))
+
+def _walk_distances(geometries):
+    """Calculate path lengths and start-to-end distances in meters for WGS84 linestrings."""
+    coords = shapely.get_coordinates(geometries)
+    offsets = np.concatenate([[0], np.cumsum(shapely.get_num_coordinates(geometries))])
+    
+    # Distance between consecutive points of the flattened coordinates,
+    # ignoring the segments joining the end of one walk to the start of the next
+    segments = _haversine(coords[:-1, 0], coords[:-1, 1], coords[1:, 0], coords[1:, 1])
+    segments[offsets[1:-1] - 1] = 0
+    lengths = np.add.reduceat(segments, offsets[:-1])
+    
+    first, last = coords[offsets[:-1]], coords[offsets[1:] - 1]
+    straight = _haversine(first[:, 0], first[:, 1], last[:, 0], last[:, 1])
+    return lengths, straight
+
+def _add_walk_metrics(walks_gdf: gpd.GeoDataFrame) -> gpd.GeoDataFrame:
+    """Attach duration, distance, sinuosity and speed columns to walks."""
+    durations = (walks_gdf.end_time - walks_gdf.start_time).dt.total_seconds().to_numpy()
+    lengths, straight = _walk_distances(walks_gdf.geometry.to_crs(DEFAULT_CRS).to_numpy())
+    
+    return walks_gdf.assign(
+        duration_s=durations,
+        length_m=lengths,
+        straight_m=straight,
+        sinuosity=np.divide(lengths, straight, out=np.ones(len(walks_gdf)), where=straight > 0),
+        avg_speed=np.divide(lengths, durations, out=np.zeros(len(walks_gdf)), where=durations > 0)
+    )
+
+def _to_metric(geometries) -> np.ndarray:
+    """Project WGS84 geometries to the metric CRS."""
+    return shapely.transform(
+        geometries, lambda xy: np.column_stack(_TO_METRIC.transform(xy[:, 0], xy[:, 1]))
+    )
+
 def process_walk_files(directory: str) -> gpd.GeoDataFrame:
     """Process all walk files in a directory."""
-    walks = []
-    tcx_files = list(Path(directory).glob('*.tcx'))
+    # Largest files first so the slowest ones do not start last and hold up the pool
+    with os.scandir(directory) as entries:
+        tcx_entries = sorted(
+            (entry for entry in entries if entry.name.endswith('.tcx') and entry.is_file()),
+            key=lambda entry: entry.stat().st_size, reverse=True
+        )
+    tcx_files = [entry.path for entry in tcx_entries]
     
     print(f"Found {len(tcx_files)} TCX files")
     
-    for file_path in tcx_files:
-        walk_data = parse_tcx_file(str(file_path))
-        if walk_data is not None:
-            # Calculate duration
-            duration = (walk_data['end_time'] - walk_data['start_time']).total_seconds()
-            
-            # Create a temporary GeoDataFrame to calculate distance in meters
-            temp_gdf = gpd.GeoDataFrame(geometry=[walk_data['geometry']], crs=DEFAULT_CRS)
-            temp_gdf = temp_gdf.to_crs(METRIC_CRS)
-            distance = temp_gdf.geometry.iloc[0].length
-            
-            # Filter out walks that are too short
-            if duration >= MIN_WALK_DURATION and distance >= MIN_WALK_DISTANCE:
-                walks.append(walk_data)
-    
+    # Parse files in parallel, each file is independent; small chunks keep
+    # the size ordering effective while batching many small files, and
+    # results are consumed as soon as any worker finishes
+    if WALK_PARALLEL_BACKEND == 'thread':
+        # lxml releases the GIL while parsing, so threads avoid process
+        # startup and pickling results back to the parent
+        pool_class, n_workers = ThreadPool, min(32, (os.cpu_count() or 1) * 4)
+    elif WALK_PARALLEL_BACKEND == 'process':
+        pool_class, n_workers = Pool, os.cpu_count() or 1
+    else:
+        raise ValueError(
+            f"Invalid WALK_PARALLEL_BACKEND {WALK_PARALLEL_BACKEND!r}, expected 'process' or 'thread'"
+        )
+    chunksize = max(1, len(tcx_files) // (n_workers * 4))
+    with pool_class(n_workers) as pool:
+        walks = [
+            walk_data
+            for walk_data in pool.imap_unordered(parse_tcx_file, tcx_files, chunksize=chunksize)
+            if walk_data is not None
+        ]
     if not walks:
         return gpd.GeoDataFrame()
     
+    # Build every walk geometry in a single call from the parsed coordinates
+    coords = [walk_data.pop('coords') for walk_data in walks]
+    geometries = shapely.linestrings(
+        np.concatenate(coords),
+        indices=np.repeat(np.arange(len(coords)), [len(c) for c in coords])
+    )
+    
     # Create GeoDataFrame
-    gdf = gpd.GeoDataFrame(walks, crs=DEFAULT_CRS)
+    gdf = gpd.GeoDataFrame(walks, geometry=geometries, crs=DEFAULT_CRS)
+    
+    # Calculate walk metrics once so later filtering is a simple mask
+    gdf = _add_walk_metrics(gdf)
+    
+    # Filter out walks that are too short
+    keep = (gdf.duration_s >= MIN_WALK_DURATION) & (gdf.length_m >= MIN_WALK_DISTANCE)
+    if not keep.any():
+        return gpd.GeoDataFrame()
+    # Order by start time so the output does not depend on worker scheduling
+    gdf = gdf.loc[keep].sort_values('start_time').reset_index(drop=True)
     
     print(f"Processed {len(gdf)} valid walks")
     return gdf
 
 def analyze_walks(walks_gdf: gpd.GeoDataFrame, streets_gdf: gpd.GeoDataFrame, city: str) -> Dict:
     """Analyze walks and calculate street coverage using optimized spatial operations."""
-    from ..utils.config import get_city_parameters
+    from ..utils.city_analyzer import get_city_parameters
     
     # Get city parameters (may trigger auto-analysis)
     params = get_city_parameters(city)
     
-    # Filter out transit trips from walks
-    valid_walks = []
-    for _, walk in walks_gdf.iterrows():
-        # Calculate metrics
-        coords = list(walk.geometry.coords)
-        duration = (walk.end_time - walk.start_time).total_seconds()
-        
-        # Calculate distance
-        temp_gdf = gpd.GeoDataFrame(geometry=[walk.geometry], crs=walks_gdf.crs)
-        temp_gdf = temp_gdf.to_crs(METRIC_CRS)
-        distance = temp_gdf.geometry.iloc[0].length
-        
-        # Calculate average speed (m/s)
-        avg_speed = distance / duration if duration > 0 else 0
-        
-        # Calculate sinuosity (path straightness)
-        start_point = Point(coords[0])
-        end_point = Point(coords[-1])
-        straight_distance = start_point.distance(end_point)
-        sinuosity = distance / straight_distance if straight_distance > 0 else 1
-        
-        # More lenient criteria for valid walks:
-        # 1. Speed within reasonable walking range (with larger buffer)
-        # 2. Allow straight paths for any distance (GPS can be inaccurate)
-        # 3. Only filter out extremely long distances
-        if (avg_speed <= params['max_walking_speed'] * 1.5 and  # Allow 50% buffer for speed
-            avg_speed >= params['min_walking_speed'] * 0.5 and  # Allow slower walking
-            distance <= params.get('max_direct_distance', 10000)):  # Use configurable max distance
-            valid_walks.append(walk)
-    
-    valid_walks_gdf = gpd.GeoDataFrame(valid_walks, crs=walks_gdf.crs)
+    # Walk metrics are calculated at ingest; older processed files may lack them
+    if not set(WALK_METRIC_COLUMNS).issubset(walks_gdf.columns):
+        walks_gdf = _add_walk_metrics(walks_gdf)
+    
+    # Filter out transit trips from walks using more lenient criteria:
+    # 1. Speed within reasonable walking range (with larger buffer)
+    # 2. Allow straight paths for any distance (GPS can be inaccurate)
+    # 3. Only filter out extremely long distances
+    valid_mask = (
+        (walks_gdf.avg_speed <= params['max_walking_speed'] * 1.5) &  # Allow 50% buffer for speed
+        (walks_gdf.avg_speed >= params['min_walking_speed'] * 0.5) &  # Allow slower walking
+        (walks_gdf.length_m <= params.get('max_direct_distance', 10000))  # Use configurable max distance
+    )
+    valid_walks_gdf = walks_gdf.loc[valid_mask]
     print(f"Found {len(valid_walks_gdf)} valid walks out of {len(walks_gdf)} total walks")
     
-    # Create a copy of streets for results
-    streets_gdf = streets_gdf.copy()
-    streets_gdf['covered'] = False
-    streets_gdf['coverage_percent'] = 0.0
+    # Simplify walks and streets in metric CRS so buffering and intersections
+    # run on fewer vertices; the street frame itself is left untouched. The
+    # tolerance scales with the buffer so the buffer edge moves by only a
+    # small fraction of its width.
+    simplify_tolerance = params['buffer_distance'] * SIMPLIFY_BUFFER_FRACTION
+    walks_metric = _to_metric(valid_walks_gdf.geometry.to_crs(DEFAULT_CRS).to_numpy())
+    walks_geom = shapely.simplify(walks_metric, simplify_tolerance)
+    streets_geom = shapely.simplify(
+        streets_gdf.geometry.to_crs(METRIC_CRS).to_numpy(), simplify_tolerance
+    )
     
-    # Convert to metric CRS for accurate buffering and distance calculations
-    valid_walks_gdf = valid_walks_gdf.to_crs(METRIC_CRS)
-    streets_gdf = streets_gdf.to_crs(METRIC_CRS)
+    # Buffer all walks at once; fewer segments per quarter circle keeps the
+    # buffered polygons small, which is what every later intersection pays for
+    walks_geom = shapely.buffer(walks_geom, params['buffer_distance'], quad_segs=4)
     
-    # Create spatial index for streets
-    streets_sindex = streets_gdf.sindex
+    # Find all intersecting (street, walk) pairs in a single tree query; each
+    # street is tested against several walks, so prepare the streets up front
+    shapely.prepare(streets_geom)
+    street_idx, walk_idx = shapely.STRtree(walks_geom).query(streets_geom, predicate='intersects')
     
-    # Buffer all walks at once and create spatial index for walks
-    buffered_walks = valid_walks_gdf.copy()
-    buffered_walks['geometry'] = buffered_walks.geometry.buffer(params['buffer_distance'])
-    walks_sindex = buffered_walks.sindex
+    # Compute covered lengths for all pairs with vectorized GEOS operations.
+    # Streets lying entirely inside a walk buffer are covered over their full
+    # length, so only the partially covered ones need a real intersection.
+    pair_streets = streets_geom[street_idx]
+    pair_walks = walks_geom[walk_idx]
+    shapely.prepare(walks_geom)
+    inside = shapely.contains_properly(pair_walks, pair_streets)
+    pair_length = shapely.length(pair_streets)
+    pair_length[~inside] = shapely.length(
+        shapely.intersection(pair_streets[~inside], pair_walks[~inside])
+    )
+    covered_length = np.zeros(len(streets_gdf))
+    np.add.at(covered_length, street_idx, pair_length)
     
-    # Process streets in larger batches for better performance
-    batch_size = 5000
-    covered_streets = []
-    
-    for i in range(0, len(streets_gdf), batch_size):
-        batch_streets = streets_gdf.iloc[i:i+batch_size]
-        
-        # Find all potentially intersecting walks for the entire batch
-        batch_bounds = batch_streets.geometry.bounds
-        possible_matches_idx = set()
-        for _, bounds in batch_bounds.iterrows():
-            # Convert bounds to tuple format (minx, miny, maxx, maxy)
-            bounds_tuple = (bounds.minx, bounds.miny, bounds.maxx, bounds.maxy)
-            matches = list(walks_sindex.intersection(bounds_tuple))
-            possible_matches_idx.update(matches)
-        
-        if not possible_matches_idx:
-            continue
-            
-        # Get the actual intersecting walks for the batch
-        relevant_walks = buffered_walks.iloc[list(possible_matches_idx)]
-        
-        # Process each street in the batch
-        for idx, street in batch_streets.iterrows():
-            # Find walks that intersect with this street
-            intersecting_walks = relevant_walks[relevant_walks.intersects(street.geometry)]
-            
-            if not intersecting_walks.empty:
-                # Calculate total covered length
-                covered_length = 0
-                for _, walk in intersecting_walks.iterrows():
-                    intersection = street.geometry.intersection(walk.geometry)
-                    if not intersection.is_empty:
-                        covered_length += intersection.length
-                
-                # Calculate coverage percentage
-                if street.geometry.length > 0:
-                    coverage_percent = (covered_length / street.geometry.length) * 100
-                    if coverage_percent > 0:
-                        street_data = street.copy()
-                        street_data['coverage_percent'] = min(coverage_percent, 100)
-                        street_data['covered'] = True
-                        covered_streets.append(street_data)
+    # Calculate coverage percentage for each street
+    street_length = shapely.length(streets_geom)
+    coverage_percent = np.divide(
+        covered_length * 100, street_length,
+        out=np.zeros(len(streets_gdf)), where=street_length > 0
+    )
     
     # Create final GeoDataFrame with only covered streets
-    if covered_streets:
-        result_streets = gpd.GeoDataFrame(covered_streets, crs=METRIC_CRS)
-    else:
-        result_streets = gpd.GeoDataFrame(geometry=[], crs=METRIC_CRS)
+    covered_mask = coverage_percent > 0
+    result_streets = streets_gdf.iloc[covered_mask].assign(
+        coverage_percent=np.minimum(coverage_percent[covered_mask], 100),
+        covered=True
+    )
     
     # Convert back to original CRS
     result_streets = result_streets.to_crs(walks_gdf.crs)
-    valid_walks_gdf = valid_walks_gdf.to_crs(walks_gdf.crs)
     
     return result_streets, valid_walks_gdf 
\ No newline at end of file
@@ -4,14 +4,24 @@ Process TCX files from Google Fit to extract street coverage data.
 """
 
 import os
+from concurrent.futures import ProcessPoolExecutor
+from functools import lru_cache
 import xml.etree.ElementTree as ET
 import geopandas as gpd
-from shapely.geometry import LineString, Point
+import shapely
 import pandas as pd
 import logging
 from pathlib import Path
-from datetime import datetime
 import numpy as np
+from src.data.walk_processor import _haversine
+
+# Prefer lxml's C parser for streaming TCX files, falling back to the standard library
+try:
+    from lxml import etree as xml_parser
+    XML_PARSE_ERRORS = (ET.ParseError, xml_parser.XMLSyntaxError)
+except ImportError:
+    xml_parser = ET
+    XML_PARSE_ERRORS = (ET.ParseError,)
 
 # Configure logging
 logging.basicConfig(
@@ -27,181 +37,224 @@ logging.basicConfig(
 TCX_NS = {
     'ns': 'http://www.garmin.com/xmlschemas/TrainingCenterDatabase/v2'
 }
+TRACKPOINT_TAG = f"{{{TCX_NS['ns']}}}Trackpoint"
+TIME_TAG = f"{{{TCX_NS['ns']}}}Time"
+POSITION_TAG = f"{{{TCX_NS['ns']}}}Position"
+LATITUDE_TAG = f"{{{TCX_NS['ns']}}}LatitudeDegrees"
+LONGITUDE_TAG = f"{{{TCX_NS['ns']}}}LongitudeDegrees"
+
+# Street network used for coverage analysis and transit detection
+STREETS_FILE = 'data/raw/nyc_streets.geojson'
 
-def safe_extract_text(element, xpath, namespaces):
-    """Safely extract text from an XML element."""
+def safe_extract_text(element, tag):
+    """Safely extract text from the child of an XML element with the given qualified tag."""
     if element is None:
         return None
-    found = element.find(xpath, namespaces)
+    found = element.find(tag)
     return found.text if found is not None else None
 
-def add_style_properties(gdf, style_type):
-    """Add style properties to the GeoDataFrame for Kepler.gl visualization."""
-    if style_type == 'walk':
-        gdf['stroke'] = '#3182CE'  # Blue color
-        gdf['stroke-width'] = 2
-        gdf['stroke-opacity'] = 0.8
-        gdf['stroke-dasharray'] = ''  # Empty string for solid line
-    elif style_type == 'street':
-        gdf['stroke'] = '#E53E3E'  # Red color for covered streets
-        gdf['stroke-width'] = 3
-        gdf['stroke-opacity'] = 0.8
-        gdf['stroke-dasharray'] = ''
-    return gdf
+def constant_category(value, length):
+    """Create a categorical column repeating a single value, stored as one-byte codes."""
+    return pd.Categorical.from_codes(np.zeros(length, dtype=np.int8), categories=[value])
+
+# Kepler.gl style properties for each layer
+STYLE_PROPERTIES = {
+    'walk': {
+        'stroke': '#3182CE',  # Blue color
+        'stroke-width': 2,
+        'stroke-opacity': 0.8,
+        'stroke-dasharray': ''  # Empty string for solid line
+    },
+    'street': {
+        'stroke': '#E53E3E',  # Red color for covered streets
+        'stroke-width': 3,
+        'stroke-opacity': 0.8,
+        'stroke-dasharray': ''
+    }
+}
+
+def style_columns(style_type, length):
+    """Build the data type and style columns for a layer, ready to pass to DataFrame.assign."""
+    columns = {'data_type': constant_category(style_type, length)}
+    for name, value in STYLE_PROPERTIES[style_type].items():
+        columns[name] = constant_category(value, length) if isinstance(value, str) else value
+    return columns
+
+def to_float_array(values):
+    """Convert numeric strings to a float array, turning unparseable values into NaN."""
+    try:
+        return np.asarray(values, dtype=np.float64)
+    except ValueError:
+        return pd.to_numeric(pd.Series(values, dtype=object), errors='coerce').to_numpy(dtype=np.float64)
 
 def parse_tcx_file(tcx_file):
     """Parse a TCX file and extract GPS coordinates and timestamps."""
     try:
-        tree = ET.parse(tcx_file)
-        root = tree.getroot()
+        time_strs = []
+        lat_strs = []
+        lon_strs = []
+        trackpoint_count = 0
         
-        # Find all trackpoints
-        trackpoints = root.findall('.//ns:Trackpoint', TCX_NS)
-        logging.info(f"Found {len(trackpoints)} trackpoints in {tcx_file}")
-        
-        data = []
-        skipped_points = 0
-        
-        for tp in trackpoints:
+        # Stream trackpoints instead of loading the whole tree, collecting raw
+        # text so the conversion below can run over all points at once. lxml
+        # filters by tag itself; ElementTree reports every element.
+        use_lxml = xml_parser is not ET
+        iterparse_options = {'tag': TRACKPOINT_TAG} if use_lxml else {}
+        for _, tp in xml_parser.iterparse(str(tcx_file), events=('end',), **iterparse_options):
+            if not use_lxml and tp.tag != TRACKPOINT_TAG:
+                continue
+            
+            trackpoint_count += 1
             try:
-                # Get time
-                time = safe_extract_text(tp, 'ns:Time', TCX_NS)
-                if time is None:
-                    skipped_points += 1
-                    continue
-                
-                # Validate timestamp format
-                try:
-                    timestamp = datetime.fromisoformat(time.replace('Z', '+00:00'))
-                except ValueError:
-                    logging.warning(f"Invalid timestamp format in {tcx_file}: {time}")
-                    skipped_points += 1
-                    continue
-                
-                # Get position
-                position = tp.find('ns:Position', TCX_NS)
-                if position is None:
-                    skipped_points += 1
-                    continue
+                time = safe_extract_text(tp, TIME_TAG)
+                position = tp.find(POSITION_TAG)
+                lat_text = safe_extract_text(position, LATITUDE_TAG)
+                lon_text = safe_extract_text(position, LONGITUDE_TAG)
                 
-                lat_text = safe_extract_text(position, 'ns:LatitudeDegrees', TCX_NS)
-                lon_text = safe_extract_text(position, 'ns:LongitudeDegrees', TCX_NS)
-                
-                if lat_text is None or lon_text is None:
-                    skipped_points += 1
-                    continue
-                
-                try:
-                    lat = float(lat_text)
-                    lon = float(lon_text)
-                    
-                    # Basic coordinate validation
-                    if not (-90 <= lat <= 90) or not (-180 <= lon <= 180):
-                        logging.warning(f"Invalid coordinates in {tcx_file}: lat={lat}, lon={lon}")
-                        skipped_points += 1
-                        continue
-                        
-                    data.append({
-                        'timestamp': timestamp,
-                        'latitude': lat,
-                        'longitude': lon
-                    })
-                except ValueError as e:
-                    logging.warning(f"Error converting coordinates in {tcx_file}: {str(e)}")
-                    skipped_points += 1
-                    continue
-                    
-            except Exception as e:
-                logging.warning(f"Error parsing trackpoint in {tcx_file}: {str(e)}")
-                skipped_points += 1
-                continue
+                if time is not None and lat_text is not None and lon_text is not None:
+                    time_strs.append(time)
+                    lat_strs.append(lat_text)
+                    lon_strs.append(lon_text)
+            finally:
+                # Release the processed trackpoint; lxml also keeps references
+                # to earlier siblings, so drop those as well
+                tp.clear()
+                if use_lxml:
+                    while tp.getprevious() is not None:
+                        del tp.getparent()[0]
+        
+        logging.info("Found %d trackpoints in %s", trackpoint_count, tcx_file)
+        
+        # Convert all trackpoints at once; unparseable values become NaT/NaN
+        timestamps = pd.to_datetime(
+            pd.Series(time_strs, dtype=object), utc=True, format='ISO8601', errors='coerce'
+        )
+        lats = to_float_array(lat_strs)
+        lons = to_float_array(lon_strs)
         
+        # Validate timestamps and coordinates
+        valid_times = timestamps.notna().to_numpy()
+        valid_coords = (lats >= -90) & (lats <= 90) & (lons >= -180) & (lons <= 180)
+        if not valid_times.all():
+            logging.warning("Invalid timestamp format for %d trackpoints in %s", (~valid_times).sum(), tcx_file)
+        if not valid_coords.all():
+            logging.warning("Invalid coordinates for %d trackpoints in %s", (~valid_coords).sum(), tcx_file)
+        
+        valid = valid_times & valid_coords
+        skipped_points = trackpoint_count - int(valid.sum())
         if skipped_points > 0:
-            logging.warning(f"Skipped {skipped_points} invalid trackpoints in {tcx_file}")
+            logging.warning("Skipped %d invalid trackpoints in %s", skipped_points, tcx_file)
         
-        if not data:
-            logging.warning(f"No valid trackpoints found in {tcx_file}")
+        if not valid.any():
+            logging.warning("No valid trackpoints found in %s", tcx_file)
             return None
             
         # Create LineString from points
-        coords = [(d['longitude'], d['latitude']) for d in data]
+        coords = np.column_stack([lons[valid], lats[valid]])
         if len(coords) < 2:
-            logging.warning(f"Not enough valid points to create LineString in {tcx_file}")
+            logging.warning("Not enough valid points to create LineString in %s", tcx_file)
             return None
-            
+        
+        timestamps = timestamps[valid]
         return {
-            'geometry': LineString(coords),
-            'start_time': data[0]['timestamp'],
-            'end_time': data[-1]['timestamp'],
+            'geometry': shapely.linestrings(coords),
+            'start_time': timestamps.iloc[0],
+            'end_time': timestamps.iloc[-1],
             'source_file': Path(tcx_file).name
         }
         
-    except ET.ParseError as e:
-        logging.error(f"XML parsing error in {tcx_file}: {str(e)}")
+    except XML_PARSE_ERRORS as e:
+        logging.error("XML parsing error in %s: %s", tcx_file, e)
         return None
     except Exception as e:
-        logging.error(f"Unexpected error processing {tcx_file}: {str(e)}")
+        logging.error("Unexpected error processing %s: %s", tcx_file, e)
         return None
 
-def analyze_street_coverage(walks_gdf, streets_gdf):
-    """Analyze which streets have been covered by the walks."""
+def analyze_street_coverage(walks_gdf, streets_gdf, street_tree=None):
+    """Analyze which streets have been covered by the walks, returning a boolean mask over streets."""
     # Buffer the walks slightly to ensure we catch streets that were walked on
-    buffered_walks = walks_gdf.copy()
-    buffered_walks['geometry'] = buffered_walks['geometry'].buffer(0.0001)  # ~11 meters
+    buffered_walks = shapely.buffer(walks_gdf.geometry.values, 0.0001)  # ~11 meters
     
-    # Find intersections between walks and streets
-    covered_streets = streets_gdf.copy()
-    covered_streets['covered'] = False
+    # Find intersections between walks and streets in a single bulk tree query
+    if street_tree is None:
+        street_tree = shapely.STRtree(streets_gdf.geometry.values)
+    street_idx = street_tree.query(buffered_walks, predicate='intersects')[1]
     
-    for _, walk in buffered_walks.iterrows():
-        # Find streets that intersect with this walk
-        intersections = streets_gdf[streets_gdf.intersects(walk['geometry'])]
-        covered_streets.loc[intersections.index, 'covered'] = True
+    covered = np.zeros(len(streets_gdf), dtype=bool)
+    covered[street_idx] = True
     
     # Add coverage statistics
-    total_streets = len(covered_streets)
-    covered_count = covered_streets['covered'].sum()
+    total_streets = len(streets_gdf)
+    covered_count = covered.sum()
     coverage_percentage = (covered_count / total_streets) * 100
     
-    logging.info(f"Street coverage analysis:")
-    logging.info(f"Total streets: {total_streets}")
-    logging.info(f"Covered streets: {covered_count}")
-    logging.info(f"Coverage percentage: {coverage_percentage:.2f}%")
+    logging.info("Street coverage analysis:")
+    logging.info("Total streets: %d", total_streets)
+    logging.info("Covered streets: %d", covered_count)
+    logging.info("Coverage percentage: %.2f%%", coverage_percentage)
     
-    return covered_streets
+    return covered
 
-def is_probable_transit(walk_data):
-    """Determine if a path is likely a transit trip."""
+def load_streets():
+    """Load the street network used for coverage analysis and transit checks."""
+    streets_gdf = gpd.read_file(STREETS_FILE, engine='pyogrio')
+    streets_gdf.set_crs(epsg=4326, inplace=True)
+    return streets_gdf
+
+@lru_cache(maxsize=1)
+def load_street_index():
+    """Load the street network and its STRtree once per process."""
+    streets_gdf = load_streets()
+    return streets_gdf, shapely.STRtree(streets_gdf.geometry.values)
+
+def is_probable_transit(walk_data, streets_gdf=None, street_tree=None):
+    """
+    Determine if a path is likely a transit trip.
+    
+    The street network and its STRtree are only needed for straight routes;
+    when not passed in they are loaded once per process on first use.
+    """
     if walk_data is None:
         return True
         
-    # Calculate metrics
-    coords = list(walk_data['geometry'].coords)
+    # Transit detection criteria
+    MAX_WALKING_SPEED = 7  # km/h
+    MIN_POINT_DENSITY = 50  # points per km
+    MIN_SINUOSITY = 1.05  # Almost straight line indicates transit
+    MIN_STREET_FOLLOWING = 0.3  # Minimum percentage of route that should follow streets
+    
+    # Cheap checks first: duration comes from the timestamps and the
+    # straight-line distance from the endpoints, neither needs a projection
+    coords = np.asarray(walk_data['geometry'].coords)
     duration = (walk_data['end_time'] - walk_data['start_time']).total_seconds()
+    (start_lon, start_lat), (end_lon, end_lat) = coords[0], coords[-1]
+    direct_distance = _haversine(start_lon, start_lat, end_lon, end_lat) / 1000  # km
+    direct_speed = direct_distance / (duration / 3600) if duration > 0 else 0  # km/h
     
-    # Calculate distance
-    temp_gdf = gpd.GeoDataFrame(geometry=[walk_data['geometry']], crs='EPSG:4326')
-    temp_gdf = temp_gdf.to_crs('EPSG:3857')  # Convert to metric CRS for accurate distance
-    distance = temp_gdf.geometry.iloc[0].length / 1000  # Convert to kilometers
+    # The path is never shorter than the straight line between its ends, so
+    # if even that is too fast for walking the trip is transit
+    if direct_speed > MAX_WALKING_SPEED:
+        logging.info(
+            "Skipping transit activity: "
+            "straight-line speed=%.2f km/h, "
+            "straight-line distance=%.2f km",
+            direct_speed, direct_distance
+        )
+        return True
+    
+    # Calculate distance as the sum of great-circle segment lengths
+    lons, lats = coords.T
+    distance = _haversine(lons[:-1], lats[:-1], lons[1:], lats[1:]).sum() / 1000  # Convert to kilometers
     
     # Calculate average speed
     avg_speed = distance / (duration / 3600) if duration > 0 else 0  # km/h
     
     # Calculate sinuosity (ratio of actual path length to straight-line distance)
-    start_point = Point(coords[0])
-    end_point = Point(coords[-1])
-    straight_distance = start_point.distance(end_point) / 1000  # Convert to kilometers
-    sinuosity = distance / straight_distance if straight_distance > 0 else 1
+    sinuosity = distance / direct_distance if direct_distance > 0 else 1
     
     # Calculate point density (points per km)
     point_density = len(coords) / distance if distance > 0 else 0
     
-    # Transit detection criteria
-    MAX_WALKING_SPEED = 7  # km/h
-    MIN_POINT_DENSITY = 50  # points per km
-    MIN_SINUOSITY = 1.05  # Almost straight line indicates transit
-    MIN_STREET_FOLLOWING = 0.3  # Minimum percentage of route that should follow streets
-    
     # First check basic transit indicators
     is_transit = (
         avg_speed > MAX_WALKING_SPEED or
@@ -213,25 +266,32 @@ def is_probable_transit(walk_data):
     # Only check street-following for straight routes
     if not is_transit and sinuosity < MIN_SINUOSITY and distance > 0.5:
         # Load street network
-        streets_gdf = gpd.read_file('data/raw/nyc_streets.geojson')
-        streets_gdf.set_crs(epsg=4326, inplace=True)
+        if streets_gdf is None:
+            streets_gdf, street_tree = load_street_index()
+        elif street_tree is None:
+            street_tree = shapely.STRtree(streets_gdf.geometry.values)
         
-        # Buffer the walk line slightly to catch nearby streets
-        buffered_walk = walk_data['geometry'].buffer(0.0001)  # ~11 meters
+        # Find streets within ~11 meters of the walk
+        walk = walk_data['geometry']
+        candidates = streets_gdf.geometry.values[
+            street_tree.query(walk, predicate='dwithin', distance=0.0001)
+        ]
         
-        # Find streets that intersect with the buffered walk
-        intersecting_streets = streets_gdf[streets_gdf.intersects(buffered_walk)]
+        # Calculate the length of the walk lying near a street. A walk lying
+        # entirely inside one street's buffer follows streets throughout;
+        # otherwise only the short walk pieces near each street are merged, so
+        # stretches near several streets, such as both directions of a two-way
+        # street, count once and crossed streets add just their buffer width.
+        street_buffers = shapely.buffer(candidates, 0.0001)
+        if shapely.contains_properly(street_buffers, walk).any():
+            street_following_length = walk.length
+        else:
+            street_following_length = shapely.union_all(
+                shapely.intersection(walk, street_buffers)
+            ).length
         
         # Calculate the percentage of the walk that follows streets
-        if not intersecting_streets.empty:
-            # Create a union of all intersecting streets
-            street_union = intersecting_streets.unary_union
-            # Calculate the length of the walk that follows streets
-            street_following_length = walk_data['geometry'].intersection(street_union).length
-            # Calculate the percentage of the walk that follows streets
-            street_following_percentage = street_following_length / walk_data['geometry'].length
-        else:
-            street_following_percentage = 0
+        street_following_percentage = street_following_length / walk.length
         
         # If the route is straight but doesn't follow streets, it's likely transit
         if street_following_percentage < MIN_STREET_FOLLOWING:
@@ -239,65 +299,68 @@ def is_probable_transit(walk_data):
     
     if is_transit:
         logging.info(
-            f"Skipping transit activity: "
-            f"avg_speed={avg_speed:.2f} km/h, "
-            f"distance={distance:.2f} km, "
-            f"sinuosity={sinuosity:.2f}, "
-            f"point_density={point_density:.1f} points/km"
-            + (f", street_following={street_following_percentage:.1%}" if 'street_following_percentage' in locals() else "")
+            "Skipping transit activity: "
+            "avg_speed=%.2f km/h, "
+            "distance=%.2f km, "
+            "sinuosity=%.2f, "
+            "point_density=%.1f points/km%s",
+            avg_speed, distance, sinuosity, point_density,
+            f", street_following={street_following_percentage:.1%}" if 'street_following_percentage' in locals() else ""
         )
     
     return is_transit
 
+def process_tcx_file(tcx_file):
+    """Parse a TCX file and return its walk data, or None if it is invalid or transit."""
+    logging.info("Processing %s", tcx_file.name)
+    walk_data = parse_tcx_file(tcx_file)
+    if walk_data is None or is_probable_transit(walk_data):
+        return None
+    return walk_data
+
 def process_tcx_files(input_dir, output_dir):
     """Process all TCX files in the input directory and save as GeoJSON."""
     input_path = Path(input_dir)
     output_path = Path(output_dir)
     output_path.mkdir(parents=True, exist_ok=True)
     
-    tcx_files = list(input_path.glob('*.tcx'))
+    # Largest files first so the slowest ones do not start last and hold up the pool
+    tcx_files = sorted(input_path.glob('*.tcx'), key=lambda p: p.stat().st_size, reverse=True)
     if not tcx_files:
-        logging.error(f"No TCX files found in {input_dir}")
+        logging.error("No TCX files found in %s", input_dir)
         return
         
-    logging.info(f"Found {len(tcx_files)} TCX files to process")
+    logging.info("Found %d TCX files to process", len(tcx_files))
     
-    walks = []
-    for tcx_file in tcx_files:
-        logging.info(f"Processing {tcx_file.name}")
-        walk_data = parse_tcx_file(tcx_file)
-        if walk_data is not None and not is_probable_transit(walk_data):
-            walks.append(walk_data)
+    # Files are independent, so parse and check them in parallel; small
+    # chunks keep the size ordering effective while batching many small files
+    chunksize = max(1, len(tcx_files) // ((os.cpu_count() or 1) * 8))
+    with ProcessPoolExecutor() as executor:
+        results = executor.map(process_tcx_file, tcx_files, chunksize=chunksize)
+        walks = [walk_data for walk_data in results if walk_data is not None]
     
     if walks:
-        # Create GeoDataFrame with walks
-        walks_gdf = gpd.GeoDataFrame(walks)
-        walks_gdf.set_crs(epsg=4326, inplace=True)  # Set WGS84 CRS
-        
-        # Add style properties for Kepler.gl
-        walks_gdf['data_type'] = 'walk'
-        walks_gdf = add_style_properties(walks_gdf, 'walk')
+        # Create GeoDataFrame with walks and style properties for Kepler.gl
+        walks_gdf = gpd.GeoDataFrame(walks, crs='EPSG:4326')  # Set WGS84 CRS
+        walks_gdf = walks_gdf.assign(**style_columns('walk', len(walks_gdf)))
         
-        # Load street network
-        streets_gdf = gpd.read_file('data/raw/nyc_streets.geojson')
-        streets_gdf.set_crs(epsg=4326, inplace=True)
+        # Load street network and its spatial index
+        streets_gdf, street_tree = load_street_index()
         
         # Analyze street coverage
-        covered_streets = analyze_street_coverage(walks_gdf, streets_gdf)
-        
-        # Filter to only covered streets
-        covered_streets = covered_streets[covered_streets['covered']]
+        covered = analyze_street_coverage(walks_gdf, streets_gdf, street_tree)
         
-        # Add style properties for covered streets
-        covered_streets['data_type'] = 'street'
-        covered_streets = add_style_properties(covered_streets, 'street')
+        # Select covered streets and add their style properties in one step
+        covered_streets = streets_gdf.loc[covered].assign(
+            covered=True, **style_columns('street', int(covered.sum()))
+        )
         
         # Save results
-        walks_gdf.to_file(output_path / 'walks.geojson', driver='GeoJSON')
-        covered_streets.to_file(output_path / 'covered_streets.geojson', driver='GeoJSON')
+        walks_gdf.to_file(output_path / 'walks.geojson', driver='GeoJSON', engine='pyogrio')
+        covered_streets.to_file(output_path / 'covered_streets.geojson', driver='GeoJSON', engine='pyogrio')
         
-        logging.info(f"Processed {len(walks)} valid walks")
-        logging.info(f"Found {len(covered_streets)} covered streets")
+        logging.info("Processed %d valid walks", len(walks))
+        logging.info("Found %d covered streets", len(covered_streets))
     else:
         logging.warning("No valid walks found to process")
 
@@ -9,9 +9,9 @@ import logging
 from pathlib import Path
 import geopandas as gpd
 from ..data.walk_processor import process_walk_files, analyze_walks
-from ..data.street_loader import load_street_network
-from ..utils.config import RAW_DATA_DIR, PROCESSED_DATA_DIR, METRIC_CRS, get_city_parameters
-from ..utils.city_analyzer import validate_city_name
+from ..data.street_loader import load_street_network, street_cache_file
+from ..utils.config import RAW_DATA_DIR, PROCESSED_DATA_DIR
+from ..utils.city_analyzer import get_city_parameters, clear_cached_parameters, validate_city_name
 
 # Configure logging
 logging.basicConfig(
@@ -89,11 +89,7 @@ Examples:
     print("Analyzing city characteristics...")
     if args.force_reanalysis:
         # Clear cache for this city
-        cache_dir = Path(PROCESSED_DATA_DIR) / 'city_cache'
-        clean_name = city.lower().replace(' ', '_').replace(',', '')
-        cache_file = cache_dir / f"{clean_name}_params.json"
-        if cache_file.exists():
-            cache_file.unlink()
+        if clear_cached_parameters(city):
             print("Cleared cached parameters, will re-analyze.")
     
     try:
@@ -123,13 +119,18 @@ Examples:
     
     # Save processed walks
     walks_file = Path(PROCESSED_DATA_DIR) / f"processed_walks_{clean_city_name}.geojson"
-    walks_gdf.to_file(walks_file, driver='GeoJSON')
+    walks_gdf.to_file(walks_file, driver='GeoJSON', engine='pyogrio')
     print(f"Saved {len(walks_gdf)} walks to {walks_file}")
     
     # Load street network
     print("\nLoading street network...")
     try:
-        streets_gdf = load_street_network(city)
+        streets_gdf = load_street_network(city, bbox=tuple(walks_gdf.total_bounds))
+        if streets_gdf.empty and os.path.exists(street_cache_file(city)):
+            # The network loaded fine, the walks just lie outside it
+            print(f"No streets in the {city} network fall inside the extent of your walks.")
+            print("Check that the walks were recorded in this city, or pick the city they belong to.")
+            sys.exit(1)
         if streets_gdf.empty:
             print("No street network could be loaded.")
             print("This could be due to:")
@@ -154,7 +155,7 @@ Examples:
     
     # Save results
     coverage_file = Path(PROCESSED_DATA_DIR) / f"street_coverage_{clean_city_name}.geojson"
-    streets_with_coverage.to_file(coverage_file, driver='GeoJSON')
+    streets_with_coverage.to_file(coverage_file, driver='GeoJSON', engine='pyogrio')
     print(f"\nSaved street coverage data to {coverage_file}")
     
     # Print summary
@@ -169,10 +170,9 @@ Examples:
     print(f"Total streets: {total_streets:,}")
     print(f"Covered streets: {len(covered_streets):,} ({coverage_percent:.1f}%)")
     
-    # Calculate total walk distance in metric CRS
+    # Total walk distance from the per-walk lengths calculated at ingest
     if not valid_walks.empty:
-        valid_walks_metric = valid_walks.to_crs(METRIC_CRS)
-        total_distance_km = valid_walks_metric.geometry.length.sum() / 1000
+        total_distance_km = valid_walks['length_m'].sum() / 1000
         print(f"Total walk distance: {total_distance_km:.1f} km")
     
     print("\nFiles generated:")
@@ -1,23 +1,31 @@
 """
 Auto-detection and analysis of city characteristics for optimal processing parameters.
+
+Heavy geospatial dependencies are imported where they are used, so loading
+cached parameters does not pay for them.
 """
-import geopandas as gpd
-import osmnx as ox
-import numpy as np
-from shapely.geometry import Point, box
-from typing import Dict, Optional, Tuple, List
+import copy
+from functools import lru_cache
+from pathlib import Path
+from typing import Callable, Dict, Optional, Tuple, List
 import logging
-from .config import DEFAULT_CRS, METRIC_CRS
+from .config import DEFAULT_CRS, METRIC_CRS, PROCESSED_DATA_DIR, LEGACY_CITY_PARAMS, get_default_parameters
 
 logger = logging.getLogger(__name__)
 
+# Directory holding cached parameters and characteristics for analyzed cities
+CITY_CACHE_DIR = str(Path(PROCESSED_DATA_DIR) / 'city_cache')
+
 class CityAnalyzer:
     """Analyzes city characteristics to determine optimal processing parameters."""
     
-    def __init__(self, city_name: str):
-        """Initialize city analyzer with city name."""
+    def __init__(self, city_name: str, cache_dir: str = None):
+        """Initialize city analyzer with city name and optional cache directory."""
         self.city_name = city_name
+        self.cache_dir = cache_dir
+        self.nodes = None
         self.street_network = None
+        self.streets_metric = None
         self.characteristics = {}
         
     def analyze_city(self) -> Dict:
@@ -29,6 +37,10 @@ class CityAnalyzer:
         """
         logger.info(f"Analyzing characteristics for {self.city_name}...")
         
+        # Reuse characteristics from an earlier analysis of this city
+        if self._load_cached_characteristics():
+            return self._calculate_optimal_parameters()
+        
         try:
             # Download street network
             self._download_street_network()
@@ -37,6 +49,7 @@ class CityAnalyzer:
             self._analyze_street_density()
             self._analyze_urban_structure()
             self._analyze_intersection_complexity()
+            self._save_cached_characteristics()
             
             # Calculate optimal parameters
             return self._calculate_optimal_parameters()
@@ -45,13 +58,68 @@ class CityAnalyzer:
             logger.warning(f"Error analyzing {self.city_name}: {e}")
             return self._get_default_parameters()
     
+    def _characteristics_cache_file(self) -> str:
+        """Get the characteristics cache file, keyed on the inputs that affect the analysis."""
+        import hashlib
+        import os
+        from importlib.metadata import version
+        
+        cache_key = hashlib.sha1(
+            f"{self.city_name}|{version('osmnx')}|{METRIC_CRS}".encode()
+        ).hexdigest()
+        return os.path.join(self.cache_dir, f"analyzer_{cache_key}.pkl")
+    
+    def _load_cached_characteristics(self) -> bool:
+        """Load characteristics from a previous analysis, returning whether they were found."""
+        if not self.cache_dir:
+            return False
+            
+        import os
+        import pickle
+        
+        try:
+            cache_file = self._characteristics_cache_file()
+            if not os.path.exists(cache_file):
+                return False
+            with open(cache_file, 'rb') as f:
+                self.characteristics = pickle.load(f)
+            logger.info(f"Loaded cached characteristics for {self.city_name}")
+            return True
+        except Exception as e:
+            logger.warning(f"Failed to load cached characteristics: {e}")
+            return False
+    
+    def _save_cached_characteristics(self):
+        """Save characteristics so later analyses of this city can skip the download."""
+        if not self.cache_dir:
+            return
+            
+        import os
+        import pickle
+        
+        try:
+            os.makedirs(self.cache_dir, exist_ok=True)
+            _write_cache_file(
+                self._characteristics_cache_file(), 'wb',
+                lambda f: pickle.dump(self.characteristics, f)
+            )
+        except Exception as e:
+            logger.warning(f"Failed to cache characteristics: {e}")
+    
     def _download_street_network(self):
         """Download street network for the city."""
+        import osmnx as ox
+        
         try:
             # Try to get the city as a place
             logger.info(f"Downloading street network for {self.city_name}...")
             graph = ox.graph_from_place(self.city_name, network_type='drive')
-            self.street_network = ox.graph_to_gdfs(graph, nodes=False, edges=True)
+            
+            # Keep the nodes as well, intersection analysis needs their street counts
+            self.nodes, self.street_network = ox.graph_to_gdfs(graph, nodes=True, edges=True)
+            
+            # Project once to metric CRS for the density and structure analyses
+            self.streets_metric = self.street_network.to_crs(METRIC_CRS)
             
             # Store bounding box
             bounds = self.street_network.bounds
@@ -66,17 +134,20 @@ class CityAnalyzer:
     
     def _analyze_street_density(self):
         """Analyze street density to determine GPS buffer requirements."""
-        if self.street_network is None:
+        if self.streets_metric is None:
             return
             
-        # Convert to metric CRS for accurate calculations
-        streets_metric = self.street_network.to_crs(METRIC_CRS)
+        import shapely
+        
+        streets_metric = self.streets_metric
         
         # Calculate total street length
         total_length = streets_metric.geometry.length.sum()
         
-        # Calculate area (using convex hull of street network)
-        area = streets_metric.geometry.unary_union.convex_hull.area
+        # Calculate area (using convex hull of street network); the hull only
+        # depends on the street vertices, so there is no need to union the lines
+        coords = shapely.get_coordinates(streets_metric.geometry.values)
+        area = shapely.convex_hull(shapely.multipoints(coords)).area
         
         # Street density (meters of street per square meter)
         street_density = total_length / area if area > 0 else 0
@@ -89,30 +160,34 @@ class CityAnalyzer:
     
     def _analyze_urban_structure(self):
         """Analyze urban structure (grid vs organic layout)."""
-        if self.street_network is None:
+        if self.streets_metric is None:
             return
             
-        # Convert to metric CRS
-        streets_metric = self.street_network.to_crs(METRIC_CRS)
+        import numpy as np
+        import shapely
         
-        # Calculate street orientations
-        orientations = []
-        for geom in streets_metric.geometry:
-            if geom.geom_type == 'LineString':
-                coords = list(geom.coords)
-                if len(coords) >= 2:
-                    # Calculate bearing of each segment
-                    for i in range(len(coords) - 1):
-                        x1, y1 = coords[i]
-                        x2, y2 = coords[i + 1]
-                        bearing = np.arctan2(y2 - y1, x2 - x1)
-                        orientations.append(np.degrees(bearing) % 180)  # Normalize to 0-180
+        streets_metric = self.streets_metric
         
-        if orientations:
-            orientations = np.array(orientations)
-            
-            # Check for grid pattern (peaks at 0° and 90°)
-            hist, bins = np.histogram(orientations, bins=18, range=(0, 180))
+        # Calculate the bearing of every LineString segment at once; segments
+        # only exist between consecutive coordinates of the same street
+        geometries = streets_metric.geometry.values
+        lines = geometries[shapely.get_type_id(geometries) == shapely.GeometryType.LINESTRING]
+        coords, line_idx = shapely.get_coordinates(lines, return_index=True)
+        starts = np.flatnonzero(line_idx[1:] == line_idx[:-1])
+        delta = coords[starts + 1] - coords[starts]
+        
+        # Convert in place so large networks only hold one array of bearings;
+        # single precision is plenty for 10° bins and halves memory traffic
+        orientations = np.empty(len(starts), dtype=np.float32)
+        np.degrees(np.arctan2(delta[:, 1], delta[:, 0]), out=orientations)
+        np.mod(orientations, 180, out=orientations)  # Normalize to 0-180
+        
+        if len(orientations):
+            # Check for grid pattern (peaks at 0° and 90°); bins are a fixed
+            # 10° wide, so each bearing's bin follows directly from its value
+            bin_idx = (orientations * np.float32(18 / 180)).astype(np.int32)
+            np.minimum(bin_idx, 17, out=bin_idx)
+            hist = np.bincount(bin_idx, minlength=18)
             
             # Look for peaks around 0°, 45°, 90°, 135°
             grid_indicators = [
@@ -133,20 +208,20 @@ class CityAnalyzer:
     
     def _analyze_intersection_complexity(self):
         """Analyze intersection complexity."""
-        if self.street_network is None:
+        if self.nodes is None:
             return
             
+        import numpy as np
+        
         try:
-            # Get the original graph to analyze intersections
-            graph = ox.graph_from_place(self.city_name, network_type='drive')
-            nodes, edges = ox.graph_to_gdfs(graph)
-            
             # Count intersection types
-            intersection_counts = nodes['street_count'].value_counts().to_dict()
+            street_counts = self.nodes['street_count'].to_numpy()
+            degrees, counts = np.unique(street_counts, return_counts=True)
+            intersection_counts = dict(zip(degrees.tolist(), counts.tolist()))
             
             # Calculate complexity metrics
-            total_intersections = len(nodes)
-            complex_intersections = sum(count for degree, count in intersection_counts.items() if degree > 4)
+            total_intersections = street_counts.size
+            complex_intersections = int((street_counts > 4).sum())
             
             complexity_ratio = complex_intersections / total_intersections if total_intersections > 0 else 0
             
@@ -206,26 +281,52 @@ class CityAnalyzer:
     
     def _get_default_parameters(self) -> Dict:
         """Get default parameters as fallback."""
-        return {
-            'buffer_distance': 8,
-            'max_walking_speed': 3.0,
-            'min_walking_speed': 0.1,
-            'max_sinuosity': 4.0,
-            'max_direct_distance': 15000,
-            'bbox': None  # Will be set from street network bounds
-        }
+        return get_default_parameters()
+
+def _write_cache_file(cache_file: str, mode: str, write: Callable) -> None:
+    """
+    Write a cache file atomically.
+    
+    Data goes to a temporary file that is renamed into place, so parallel runs
+    or an interrupted write never leave a truncated cache. The temporary file
+    is removed if writing fails.
+    """
+    import os
+    
+    tmp_file = f"{cache_file}.{os.getpid()}.tmp"
+    try:
+        with open(tmp_file, mode) as f:
+            write(f)
+        os.replace(tmp_file, cache_file)
+    except BaseException:
+        if os.path.exists(tmp_file):
+            os.remove(tmp_file)
+        raise
 
-def get_city_parameters(city_name: str, cache_dir: str = None) -> Dict:
+def get_city_parameters(city_name: str, cache_dir: str = CITY_CACHE_DIR) -> Dict:
     """
-    Get optimized parameters for any city.
+    Get optimized parameters for any city, using legacy configs or auto-detection.
+    
+    Results are cached per city name; each call returns a fresh copy so
+    callers can modify it without affecting later lookups.
     
     Args:
-        city_name: Name of the city to analyze
+        city_name: Name of the city (can be any city worldwide)
         cache_dir: Directory to cache analysis results
         
     Returns:
         Dictionary of optimized parameters for the city
     """
+    return copy.deepcopy(_load_city_parameters(city_name, cache_dir))
+
+@lru_cache(maxsize=64)
+def _load_city_parameters(city_name: str, cache_dir: str) -> Dict:
+    """Look up or analyze the parameters for a city."""
+    # Check if it's a legacy city with predefined parameters
+    if city_name.lower() in LEGACY_CITY_PARAMS:
+        logger.info(f"Using legacy parameters for {city_name}")
+        return LEGACY_CITY_PARAMS[city_name.lower()]
+    
     # Clean up city name for caching
     clean_name = city_name.lower().replace(' ', '_').replace(',', '')
     
@@ -244,21 +345,48 @@ def get_city_parameters(city_name: str, cache_dir: str = None) -> Dict:
                 logger.warning(f"Failed to load cached parameters: {e}")
     
     # Analyze the city
-    analyzer = CityAnalyzer(city_name)
+    analyzer = CityAnalyzer(city_name, cache_dir)
     params = analyzer.analyze_city()
     
     # Cache the results
     if cache_dir:
         try:
             os.makedirs(cache_dir, exist_ok=True)
-            with open(cache_file, 'w') as f:
-                json.dump(params, f, indent=2)
+            _write_cache_file(cache_file, 'w', lambda f: json.dump(params, f, indent=2))
             logger.info(f"Cached parameters for {city_name}")
         except Exception as e:
             logger.warning(f"Failed to cache parameters: {e}")
     
     return params
 
+def clear_cached_parameters(city_name: str, cache_dir: str = CITY_CACHE_DIR) -> bool:
+    """
+    Remove cached parameters and characteristics so the city is analyzed again.
+    
+    Args:
+        city_name: Name of the city
+        cache_dir: Directory holding cached analysis results
+        
+    Returns:
+        True if any cache file was removed, False otherwise
+    """
+    import os
+    
+    clean_name = city_name.lower().replace(' ', '_').replace(',', '')
+    cache_files = [
+        os.path.join(cache_dir, f"{clean_name}_params.json"),
+        CityAnalyzer(city_name, cache_dir)._characteristics_cache_file()
+    ]
+    
+    removed = False
+    for cache_file in cache_files:
+        if os.path.exists(cache_file):
+            os.remove(cache_file)
+            removed = True
+    
+    _load_city_parameters.cache_clear()
+    return removed
+
 def validate_city_name(city_name: str) -> bool:
     """
     Validate if a city name can be processed.
@@ -270,18 +398,12 @@ def validate_city_name(city_name: str) -> bool:
         True if city can be processed, False otherwise
     """
     try:
-        # Try a simple test query with timeout
+        # Geocoding only fetches the city boundary, which is enough to know
+        # the name resolves without downloading its street network
         import osmnx as ox
-        # Set a shorter timeout for validation
-        old_timeout = ox.settings.timeout
-        ox.settings.timeout = 30  # 30 seconds timeout
-        
-        test_graph = ox.graph_from_place(city_name, network_type='drive')
-        
-        # Restore original timeout
-        ox.settings.timeout = old_timeout
+        city_gdf = ox.geocode_to_gdf(city_name)
         
-        return len(test_graph.nodes) > 10  # Must have at least some street network
+        return len(city_gdf) > 0 and not city_gdf.geometry.iloc[0].is_empty
     except Exception as e:
         # Log the specific error for debugging
         logger.debug(f"City validation failed for '{city_name}': {e}")
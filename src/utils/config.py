@@ -1,8 +1,6 @@
 """
 Configuration settings for street coverage mapping.
 """
-import logging
-from pathlib import Path
 
 # Legacy city parameters for backwards compatibility
 LEGACY_CITY_PARAMS = {
@@ -59,30 +57,6 @@ LEGACY_CITY_PARAMS = {
     }
 }
 
-def get_city_parameters(city_name: str):
-    """
-    Get parameters for any city, using auto-detection or legacy configs.
-    
-    Args:
-        city_name: Name of the city (can be any city worldwide)
-        
-    Returns:
-        Dict containing optimized parameters for the city
-    """
-    # Check if it's a legacy city with predefined parameters
-    if city_name.lower() in LEGACY_CITY_PARAMS:
-        logging.info(f"Using legacy parameters for {city_name}")
-        return LEGACY_CITY_PARAMS[city_name.lower()]
-    
-    # Use auto-detection for new cities
-    try:
-        from .city_analyzer import get_city_parameters as analyze_city
-        cache_dir = str(Path(PROCESSED_DATA_DIR) / 'city_cache')
-        return analyze_city(city_name, cache_dir)
-    except ImportError:
-        logging.error("City analyzer not available, falling back to default parameters")
-        return get_default_parameters()
-
 def get_default_parameters():
     """Get default parameters for unknown cities."""
     return {
@@ -97,6 +71,13 @@ def get_default_parameters():
 # For backwards compatibility
 CITY_PARAMS = LEGACY_CITY_PARAMS
 
+def __getattr__(name):
+    """Resolve get_city_parameters lazily, city_analyzer imports this module."""
+    if name == 'get_city_parameters':
+        from .city_analyzer import get_city_parameters
+        return get_city_parameters
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
 # File paths
 DATA_DIR = 'data'
 RAW_DATA_DIR = f'{DATA_DIR}/raw'
@@ -109,4 +90,5 @@ METRIC_CRS = 'EPSG:3857'   # Web Mercator
 # Analysis settings
 MIN_WALK_DURATION = 0  # seconds
 MIN_WALK_DISTANCE = 0  # meters
-GPS_ACCURACY = 15  # meters - increased for urban environments 
\ No newline at end of file
+GPS_ACCURACY = 15  # meters - increased for urban environments
+SIMPLIFY_BUFFER_FRACTION = 0.1  # simplification tolerance as a fraction of the walk buffer distance
\ No newline at end of file
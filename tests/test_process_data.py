@@ -0,0 +1,67 @@
+"""
+Tests for transit detection in process_data.
+"""
+import importlib
+
+import geopandas as gpd
+import numpy as np
+import pandas as pd
+import pytest
+from shapely.geometry import LineString
+
+LAT = 40.7
+LON = -74.0
+WALK_KM = 2.5
+DEG_PER_M_LAT = 1 / 111320
+DEG_PER_M_LON = 1 / (111320 * np.cos(np.radians(LAT)))
+
+
+@pytest.fixture
+def process_data(tmp_path, monkeypatch):
+    """Import process_data from a temporary directory so its log file lands there."""
+    monkeypatch.chdir(tmp_path)
+    return importlib.import_module('src.process_data')
+
+
+def straight_walk():
+    """A dense, straight 2.5 km east-west walk at walking pace."""
+    lons = np.linspace(LON, LON + WALK_KM * 1000 * DEG_PER_M_LON, 500)
+    return {
+        'geometry': LineString(np.column_stack([lons, np.full(len(lons), LAT)])),
+        'start_time': pd.Timestamp('2024-01-01 09:00', tz='UTC'),
+        'end_time': pd.Timestamp('2024-01-01 09:40', tz='UTC'),
+    }
+
+
+def east_west_street(start_m, end_m, offset_m=0):
+    """A street parallel to the walk, offset north by offset_m meters."""
+    lat = LAT + offset_m * DEG_PER_M_LAT
+    return LineString([
+        (LON + start_m * DEG_PER_M_LON, lat),
+        (LON + end_m * DEG_PER_M_LON, lat),
+    ])
+
+
+def streets(geometries):
+    return gpd.GeoDataFrame(geometry=geometries, crs='EPSG:4326')
+
+
+def test_walk_along_street_is_not_transit(process_data):
+    network = streets([east_west_street(-50, WALK_KM * 1000 + 50)])
+    assert not process_data.is_probable_transit(straight_walk(), network)
+
+
+def test_parallel_streets_are_not_counted_twice(process_data):
+    # Two parallel streets run alongside the first 20% of the walk; counted
+    # once that is below the street-following threshold, counted twice above
+    network = streets([east_west_street(0, 500), east_west_street(0, 500, offset_m=5)])
+    assert process_data.is_probable_transit(straight_walk(), network)
+
+
+def test_straight_trip_across_street_grid_is_transit(process_data):
+    # North-south streets every 80 meters, both directions of each present
+    crossings = []
+    for x in np.arange(0, WALK_KM * 1000, 80):
+        lon = LON + x * DEG_PER_M_LON
+        crossings += [LineString([(lon, LAT - 0.01), (lon, LAT + 0.01)])] * 2
+    assert process_data.is_probable_transit(straight_walk(), streets(crossings))